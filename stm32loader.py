@@ -23,14 +23,11 @@
 # <http://www.gnu.org/licenses/>.
 
 import sys, getopt
-import serial
 import time
-
-try:
-    from progressbar import *
-    usepbar = 1
-except:
-    usepbar = 0
+import io
+import binascii
+import struct
+import mmap
 
 # Verbose level
 QUIET = 20
@@ -48,18 +45,198 @@ chip_ids = {
     0x413: "STM32F4xx",
 }
 
-def mdebug(level, message):
+# byte followed by its complement, as sent for commands and read lengths
+byte_frames = tuple([chr(i) + chr(i ^ 0xFF) for i in range(256)])
+
+def _xor_reduce(data, init=0):
+    # XOR all bytes of data (and init) together: load the buffer as one big
+    # int, then fold its halves onto each other, log2(n) C-level steps
+    n = len(data)
+    if not n:
+        return init
+    acc = int(binascii.hexlify(data), 16)
+    while n > 1:
+        half = n >> 1
+        bits = (n - half) * 8
+        acc = (acc >> bits) ^ (acc & ((1 << bits) - 1))
+        n = n - half
+    return int(acc ^ init)
+
+def page_xors(data, size):
+    # XOR of every size-byte page of data, the last one padded with 0xFF;
+    # the whole pages are reduced in one vectorized pass straight over the
+    # caller's buffer, so the image is never copied. Only if numpy is
+    # already loaded: importing it takes longer than _xor_reduce needs for
+    # a whole image. Otherwise [None]*pages, and callers fall back to
+    # computing each page on its own
+    n = len(data)
+    pages = max(1, (n + size - 1) // size)
+    numpy = sys.modules.get('numpy')
+    if numpy is None:
+        return [None] * pages
+    full = n // size
+    xors = []
+    if full:
+        arr = numpy.frombuffer(data, dtype=numpy.uint8, count=full * size)
+        xors = numpy.bitwise_xor.reduce(arr.reshape(full, size), axis=1).tolist()
+    if pages > full:
+        # short last page: its own bytes plus an odd or even run of 0xFF
+        pad = size - (n - full * size)
+        xors.append(_xor_reduce(data[full * size:], 0xFF * (pad & 1)))
+    return xors
+
+def first_mismatch(a, b):
+    # index of the first differing byte of two buffers, or None if they
+    # are equal; halves the range with C-level block compares
+    n = min(len(a), len(b))
+    va = memoryview(a)
+    vb = memoryview(b)
+    if va[:n] == vb[:n]:
+        if len(a) == len(b):
+            return None
+        return n
+    lo, hi = 0, n
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if va[lo:mid] == vb[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def mismatches(a, b):
+    # indices where two equally long buffers differ; numpy compares them
+    # in one vectorized pass, otherwise scan from the first difference
+    numpy = optional_import('numpy')
+    if numpy is not None:
+        diff = numpy.frombuffer(a, numpy.uint8) != numpy.frombuffer(b, numpy.uint8)
+        return numpy.flatnonzero(diff).tolist()
+    start = first_mismatch(a, b)
+    if start is None:
+        return []
+    return [i for i in xrange(start, len(a)) if a[i] != b[i]]
+
+# optional modules by name, None when not installed; they are imported on
+# first use so paths that never need them don't pay for loading them
+optional_modules = {}
+
+def optional_import(name):
+    if name not in optional_modules:
+        try:
+            optional_modules[name] = __import__(name)
+        except ImportError:
+            optional_modules[name] = None
+    return optional_modules[name]
+
+def mdebug(level, message, *args):
+    # format only when the message will actually be printed
     if(QUIET >= level):
+        if args:
+            message = message % args
         print >> sys.stderr , message
 
 
+class _BatchedProgress:
+    # forwards updates to a ProgressBar every 16 chunks or 0.1 s at most,
+    # since each redraw writes escape sequences to the terminal
+
+    def __init__(self, pbar, every=16, interval=0.1):
+        self.pbar = pbar
+        self.maxval = pbar.maxval
+        self.every = every
+        self.interval = interval
+        self.value = 0
+        self.pending = 0
+        self.last = time.time()
+
+    def update(self, value):
+        self.value = value
+        self.pending = self.pending + 1
+        now = time.time()
+        if self.pending >= self.every or now - self.last > self.interval:
+            self.pbar.update(value)
+            self.pending = 0
+            self.last = now
+
+    def finish(self):
+        # bring the bar to the true count before closing it
+        self.pbar.update(self.value)
+        self.pbar.finish()
+
+
+def read_hex(filename):
+    # minimal Intel HEX reader, used when neither bincopy nor intelhex is
+    # installed; each record is decoded with a single unhexlify call
+    chunks = []
+    base = 0
+    for line in file(filename, 'rb'):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] != ':':
+            raise Exception("Not an Intel HEX record: " + line)
+        rec = bytearray(binascii.unhexlify(line[1:]))
+        # count, address, type, data and a checksum that sums to zero
+        if len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xFF:
+            raise Exception("Bad Intel HEX record: " + line)
+        kind = rec[3]
+        if kind == 0:
+            chunks.append((base + (rec[1] << 8 | rec[2]), rec[4:-1]))
+        elif kind == 1:
+            break
+        elif kind == 2:
+            base = (rec[4] << 8 | rec[5]) << 4
+        elif kind == 4:
+            base = (rec[4] << 8 | rec[5]) << 16
+    if not chunks:
+        return None, bytearray()
+    # one packed buffer from the lowest address, gaps filled with 0xFF
+    start = min([addr for addr, data in chunks])
+    end = max([addr + len(data) for addr, data in chunks])
+    image = bytearray("\xFF" * (end - start))
+    for addr, data in chunks:
+        image[addr - start:addr - start + len(data)] = data
+    return start, image
+
+def load_image(filename):
+    # returns (base, data): base is the address a .hex image was linked
+    # at, None for raw binaries which carry no address
+    if filename.lower().endswith(".hex"):
+        bincopy = optional_import('bincopy')
+        if bincopy is not None:
+            # faster parser, returns the image as one buffer directly
+            bf = bincopy.BinFile()
+            bf.add_ihex_file(filename)
+            return bf.minimum_address, bytearray(bf.as_binary())
+        intelhex = optional_import('intelhex')
+        if intelhex is None:
+            return read_hex(filename)
+        ih = intelhex.IntelHex(filename)
+        # one packed buffer from the lowest address, gaps filled with 0xFF
+        return ih.minaddr(), bytearray(ih.tobinarray(start=ih.minaddr()))
+    f = file(filename, 'rb')
+    try:
+        # map the image instead of copying it onto the heap; buffer() is
+        # the zero-copy view Python 2 can hand to memoryview
+        return None, buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (ValueError, mmap.error):
+        # empty files and special files can't be mapped
+        return None, bytearray(f.read())
+    finally:
+        f.close()
+
 class CmdException(Exception):
     pass
 
 class CommandInterface:
     extended_erase = 0
+    # bytes per ReadMemory/WriteMemory command; 256 is the protocol maximum
+    data_transfer_size = 256
+    _addr_struct = struct.Struct(">IB")
 
-    def open(self, aport='/dev/tty.usbserial-ftCYPMYJ', abaudrate=115200) :
+    def open(self, aport='/dev/tty.usbserial-ftCYPMYJ', abaudrate=115200, buffered=True, low_latency=True) :
+        # imported here so -h and option errors don't load pyserial
+        import serial
         self.sp = serial.Serial(
             port=aport,
             baudrate=abaudrate,     # baudrate
@@ -68,27 +245,129 @@ class CommandInterface:
             stopbits=1,
             xonxoff=0,              # don't enable software flow control
             rtscts=0,               # don't enable RTS/CTS flow control
-            timeout=5               # set a timeout value, None for waiting forever
+            timeout=5,              # set a timeout value, None for waiting forever
+            writeTimeout=None,      # don't time out large batched writes
+            interCharTimeout=None   # don't wait between received bytes
         )
+        self._low_latency = False
+        if low_latency and hasattr(self.sp, 'set_low_latency_mode'):
+            # pyserial >= 3.5 on Linux: ASYNC_LOW_LATENCY cuts ACK turnaround.
+            # It outlives the port, so releaseChip() clears it again; other
+            # platforms raise NotImplementedError
+            try:
+                self.sp.set_low_latency_mode(True)
+                self._low_latency = True
+            except (IOError, OSError, ValueError, NotImplementedError):
+                pass
+        if buffered:
+            # coalesce small writes; the port must be a raw file-like object
+            # whose write() returns the number of bytes written (pyserial is)
+            self._writer = io.BufferedWriter(self.sp, 8192)
+        else:
+            self._writer = self.sp
+        self._buffered = buffered
+        # bound methods for the hot paths; self.sp stays for everything else
+        self._conn_write = self._writer.write
+        self._conn_read = self.sp.read
+        self._conn_readinto = self.sp.readinto
+
+    def _write(self, *parts):
+        # ints are single bytes
+        if self._buffered:
+            # the BufferedWriter already gathers the parts into one port
+            # write, so pass them through instead of joining them first
+            write = self._conn_write
+            for part in parts:
+                if type(part) is int:
+                    write(chr(part))
+                else:
+                    write(part)
+            return
+        # unbuffered: join several parts into one write
+        if len(parts) == 1:
+            data = parts[0]
+        else:
+            data = bytearray()
+            for part in parts:
+                if type(part) is int:
+                    data.append(part)
+                else:
+                    data.extend(part)
+        self._conn_write(data)
+
+    def _flush(self):
+        if self._writer is not self.sp:
+            self._writer.flush()
+
+    def tuneTimeouts(self, read=None, write=None):
+        # adjust read/write timeouts of the open port, None keeps the current value
+        if read is not None:
+            self.sp.timeout = read
+        if write is not None:
+            self.sp.writeTimeout = write
 
 
     def _wait_for_ask(self, info = ""):
-        # wait for ask
-        try:
-            ask = ord(self.sp.read())
-        except:
+        # send anything still buffered, then wait for ask
+        self._flush()
+        return self._check_ask(self._read_byte(), info)
+
+    def _wait_for_ask_and_read_into(self, view, info = ""):
+        # ACK, then len(view) reply bytes read straight into view. The ACK
+        # is read on its own so a NACK fails at once instead of after the
+        # payload read times out; filling view saves the bytearray copy and
+        # slice assignment a read() reply would need
+        self._wait_for_ask(info)
+        if self._conn_readinto(view) != len(view):
+            raise CmdException("Can't read port or timeout")
+
+    def _read_byte(self):
+        # pyserial returns an empty string on timeout
+        data = self._conn_read()
+        if not data:
             raise CmdException("Can't read port or timeout")
+        return ord(data)
+
+    def _wait_for_ask_long(self, total_timeout, info = ""):
+        # poll with short reads so slow operations can report progress
+        self._flush()
+        tmp = self.sp.timeout
+        self.sp.timeout = 0.5
+        try:
+            start = time.time()
+            nag = start + 1
+            while True:
+                ask = self._conn_read()
+                if ask:
+                    return self._check_ask(ord(ask), info)
+                now = time.time()
+                if now - start >= total_timeout:
+                    raise CmdException("Can't read port or timeout")
+                if now >= nag:
+                    mdebug(10, "    still erasing...")
+                    nag = now + 1
+        finally:
+            self.sp.timeout = tmp
+
+    def _check_ask(self, ask, info = ""):
+        if ask == 0x79:
+            # ACK
+            return 1
         else:
-            if ask == 0x79:
-                # ACK
-                return 1
+            if ask == 0x1F:
+                # NACK
+                raise CmdException("NACK "+info)
             else:
-                if ask == 0x1F:
-                    # NACK
-                    raise CmdException("NACK "+info)
-                else:
-                    # Unknown responce
-                    raise CmdException("Unknown response. "+info+": "+hex(ask))
+                # Unknown responce
+                raise CmdException("Unknown response. "+info+": "+hex(ask))
+
+    def _read_reply(self, n):
+        # one read for the whole reply; pyserial only comes back short once
+        # the whole timeout has passed, so that is an error, not a retry
+        data = self._conn_read(n)
+        if len(data) != n:
+            raise CmdException("Can't read port or timeout")
+        return data
 
 
     def reset(self):
@@ -102,29 +381,59 @@ class CommandInterface:
         self.sp.setRTS(0)
         self.reset()
 
-        self.sp.write("\x7F")       # Syncro
+        # drop stale bytes so they don't poison the ACK stream
+        self.sp.flushInput()
+        self.sp.flushOutput()
+        self._write("\x7F")       # Syncro
         return self._wait_for_ask("Syncro")
 
+    def _resync(self, total_timeout=25):
+        # the chip resets itself after some commands; keep sending sync
+        # bytes until the restarted bootloader answers
+        tmp = self.sp.timeout
+        self.sp.timeout = 0.5
+        try:
+            start = time.time()
+            while time.time() - start < total_timeout:
+                self._write("\x7F")
+                self._flush()
+                ask = self._conn_read()
+                if ask == "\x79" or ask == "\x1F":
+                    # ACK, or NACK from a bootloader that was already synced
+                    return 1
+            raise CmdException("No answer from bootloader after reset")
+        finally:
+            self.sp.timeout = tmp
+
     def releaseChip(self):
         self.sp.setRTS(1)
         self.reset()
+        if self._low_latency:
+            try:
+                self.sp.set_low_latency_mode(False)
+            except (IOError, OSError, ValueError):
+                pass
+            self._low_latency = False
 
     def cmdGeneric(self, cmd):
-        self.sp.write(chr(cmd))
-        self.sp.write(chr(cmd ^ 0xFF)) # Control byte
+        self._write(byte_frames[cmd]) # command and control byte
         return self._wait_for_ask(hex(cmd))
 
     def cmdGet(self):
         if self.cmdGeneric(0x00):
             mdebug(10, "*** Get command");
-            len = ord(self.sp.read())
-            version = ord(self.sp.read())
-            mdebug(10, "    Bootloader version: "+hex(version))
-            dat = map(lambda c: hex(ord(c)), self.sp.read(len))
-            if '0x44' in dat:
+            N = self._read_byte()
+            # version, N command codes and the closing ACK in one read
+            reply = bytearray(self._read_reply(N + 2))
+            self._check_ask(reply[-1], "0x00 end")
+            version = reply[0]
+            mdebug(10, "    Bootloader version: 0x%x", version)
+            dat = reply[1:-1]
+            if 0x44 in dat:
                 self.extended_erase = 1
-            mdebug(10, "    Available commands: "+", ".join(dat))
-            self._wait_for_ask("0x00 end")
+            if QUIET >= 10:
+                # the list is only worth joining when it will be printed
+                mdebug(10, "    Available commands: %s", ", ".join(map(hex, dat)))
             return version
         else:
             raise CmdException("Get (0x00) failed")
@@ -132,10 +441,11 @@ class CommandInterface:
     def cmdGetVersion(self):
         if self.cmdGeneric(0x01):
             mdebug(10, "*** GetVersion command")
-            version = ord(self.sp.read())
-            self.sp.read(2)
-            self._wait_for_ask("0x01 end")
-            mdebug(10, "    Bootloader version: "+hex(version))
+            # version, two option bytes and the closing ACK
+            reply = bytearray(self._read_reply(4))
+            self._check_ask(reply[3], "0x01 end")
+            version = reply[0]
+            mdebug(10, "    Bootloader version: 0x%x", version)
             return version
         else:
             raise CmdException("GetVersion (0x01) failed")
@@ -143,62 +453,76 @@ class CommandInterface:
     def cmdGetID(self):
         if self.cmdGeneric(0x02):
             mdebug(10, "*** GetID command")
-            len = ord(self.sp.read())
-            id = self.sp.read(len+1)
-            self._wait_for_ask("0x02 end")
-            return reduce(lambda x, y: x*0x100+y, map(ord, id))
+            N = self._read_byte()
+            # N+1 id bytes and the closing ACK
+            reply = self._read_reply(N + 2)
+            self._check_ask(ord(reply[-1]), "0x02 end")
+            # big-endian bytes to int in C; int.from_bytes is py3 only
+            return int(binascii.hexlify(reply[:-1]), 16)
         else:
             raise CmdException("GetID (0x02) failed")
 
 
     def _encode_addr(self, addr):
-        byte3 = (addr >> 0) & 0xFF
-        byte2 = (addr >> 8) & 0xFF
-        byte1 = (addr >> 16) & 0xFF
-        byte0 = (addr >> 24) & 0xFF
-        crc = byte0 ^ byte1 ^ byte2 ^ byte3
-        return (chr(byte0) + chr(byte1) + chr(byte2) + chr(byte3) + chr(crc))
-
-
-    def cmdReadMemory(self, addr, lng):
-        assert(lng <= 256)
+        # four address bytes and their XOR, packed in one go
+        crc = ((addr >> 24) ^ (addr >> 16) ^ (addr >> 8) ^ addr) & 0xFF
+        return self._addr_struct.pack(addr, crc)
+
+
+    def cmdReadMemory(self, addr, lng, into = None):
+        # into: optional writable memoryview of lng bytes to fill instead
+        # of returning a new bytearray
+        if lng > 256:
+            # too big for one command; let the chunking loop split it
+            data = self.readMemory(addr, lng)
+            if into is None:
+                return data
+            into[:] = data
+            return
         if self.cmdGeneric(0x11):
             mdebug(10, "*** ReadMemory command")
-            self.sp.write(self._encode_addr(addr))
+            self._write(self._encode_addr(addr))
             self._wait_for_ask("0x11 address failed")
             N = (lng - 1) & 0xFF
-            crc = N ^ 0xFF
-            self.sp.write(chr(N) + chr(crc))
-            self._wait_for_ask("0x11 length failed")
-            return map(lambda c: ord(c), self.sp.read(lng))
+            self._write(byte_frames[N]) # length and its complement
         else:
             raise CmdException("ReadMemory (0x11) failed")
+        if into is None:
+            data = bytearray(lng)
+            self._wait_for_ask_and_read_into(memoryview(data), "0x11 length failed")
+            return data
+        self._wait_for_ask_and_read_into(into, "0x11 length failed")
 
 
     def cmdGo(self, addr):
         if self.cmdGeneric(0x21):
             mdebug(10, "*** Go command")
-            self.sp.write(self._encode_addr(addr))
+            self._write(self._encode_addr(addr))
             self._wait_for_ask("0x21 go failed")
         else:
             raise CmdException("Go (0x21) failed")
 
 
-    def cmdWriteMemory(self, addr, data):
-        assert(len(data) <= 256)
+    def cmdWriteMemory(self, addr, data, xor = None):
+        if len(data) > 256:
+            # split into commands, writing only the bytes given
+            return self.writeMemory(addr, data, pad = False)
         if self.cmdGeneric(0x31):
             mdebug(10, "*** Write memory command")
-            self.sp.write(self._encode_addr(addr))
+            self._write(self._encode_addr(addr))
             self._wait_for_ask("0x31 address failed")
-            #map(lambda c: hex(ord(c)), data)
+            # the only copy of the chunk; data may be a list or a memoryview
+            data = bytearray(data)
             lng = (len(data)-1) & 0xFF
-            mdebug(10, "    %s bytes to write" % [lng+1]);
-            self.sp.write(chr(lng)) # len really
-            crc = 0xFF
-            for c in data:
-                crc = crc ^ c
-                self.sp.write(chr(c))
-            self.sp.write(chr(crc))
+            mdebug(10, "    %d bytes to write", lng+1)
+            # XOR of the length byte and all data bytes; xor is the data
+            # part when the caller has already computed it
+            if xor is None:
+                crc = _xor_reduce(data, lng)
+            else:
+                crc = xor ^ lng
+            # length, data and checksum in a single port write
+            self._write(lng, data, crc)
             self._wait_for_ask("0x31 programming failed")
             mdebug(10, "    Write memory done")
         else:
@@ -207,40 +531,50 @@ class CommandInterface:
 
     def cmdEraseMemory(self, sectors = None):
         if self.extended_erase:
-            return cmd.cmdExtendedEraseMemory()
+            return self.cmdExtendedEraseMemory(sectors)
 
         if self.cmdGeneric(0x43):
             mdebug(10, "*** Erase memory command")
             if sectors is None:
                 # Global erase
-                self.sp.write(chr(0xFF))
-                self.sp.write(chr(0x00))
+                self._write("\xFF\x00")
             else:
                 # Sectors erase
-                self.sp.write(chr((len(sectors)-1) & 0xFF))
-                crc = 0xFF
-                for c in sectors:
-                    crc = crc ^ c
-                    self.sp.write(chr(c))
-                self.sp.write(chr(crc))
+                if not isinstance(sectors, bytearray):
+                    sectors = bytearray(sectors)
+                N = (len(sectors)-1) & 0xFF
+                # checksum covers the count byte too (AN3155)
+                crc = _xor_reduce(sectors, N)
+                self._write(N, sectors, crc)
             self._wait_for_ask("0x43 erasing failed")
             mdebug(10, "    Erase memory done")
         else:
             raise CmdException("Erase memory (0x43) failed")
 
-    def cmdExtendedEraseMemory(self):
+    def cmdExtendedEraseMemory(self, pages = None):
+        if isinstance(pages, str):
+            # a byte string of page numbers, as cmdEraseMemory accepts
+            pages = bytearray(pages)
+        if pages is not None:
+            # checked before the command is sent; counts of 0xFFF0 and up
+            # are the special erase codes
+            if not 0 < len(pages) <= 0xFFF0:
+                raise CmdException("Extended erase needs 1 to 65520 pages")
+            for page in pages:
+                if not 0 <= page <= 0xFFFF:
+                    raise CmdException("Page number out of range: %r" % (page,))
         if self.cmdGeneric(0x44):
             mdebug(10, "*** Extended Erase memory command")
-            # Global mass erase
-            self.sp.write(chr(0xFF))
-            self.sp.write(chr(0xFF))
-            # Checksum
-            self.sp.write(chr(0x00))
-            tmp = self.sp.timeout
-            self.sp.timeout = 30
-            print "Extended erase (0x44), this can take ten seconds or more"
-            self._wait_for_ask("0x44 erasing failed")
-            self.sp.timeout = tmp
+            if pages is None:
+                # Global mass erase code and checksum
+                self._write("\xFF\xFF\x00")
+                print "Extended erase (0x44), this can take ten seconds or more"
+            else:
+                # page count - 1 and page numbers, 16 bit big endian, packed
+                # in one call
+                frame = struct.pack(">%dH" % (len(pages) + 1), len(pages) - 1, *pages)
+                self._write(frame, _xor_reduce(frame))
+            self._wait_for_ask_long(30, "0x44 erasing failed")
             mdebug(10, "    Extended Erase memory done")
         else:
             raise CmdException("Extended Erase memory (0x44) failed")
@@ -248,12 +582,11 @@ class CommandInterface:
     def cmdWriteProtect(self, sectors):
         if self.cmdGeneric(0x63):
             mdebug(10, "*** Write protect command")
-            self.sp.write(chr((len(sectors)-1) & 0xFF))
-            crc = 0xFF
-            for c in sectors:
-                crc = crc ^ c
-                self.sp.write(chr(c))
-            self.sp.write(chr(crc))
+            if not isinstance(sectors, bytearray):
+                sectors = bytearray(sectors)
+            N = (len(sectors)-1) & 0xFF
+            crc = _xor_reduce(sectors, N)
+            self._write(N, sectors, crc)
             self._wait_for_ask("0x63 write protect failed")
             mdebug(10, "    Write protect done")
         else:
@@ -280,8 +613,10 @@ class CommandInterface:
     def cmdReadoutUnprotect(self):
         if self.cmdGeneric(0x92):
             mdebug(10, "*** Readout Unprotect command")
-            self._wait_for_ask("0x92 readout unprotect failed")
-            self._wait_for_ask("0x92 readout unprotect 2 failed")
+            # the second ACK only comes once the mass erase is done
+            self._wait_for_ask_long(30, "0x92 readout unprotect failed")
+            # then it resets; poll until the bootloader is back
+            self._resync()
             mdebug(10, "    Read Unprotect done")
         else:
             raise CmdException("Readout unprotect (0x92) failed")
@@ -290,49 +625,116 @@ class CommandInterface:
 # Complex commands section
 
     def readMemory(self, addr, lng):
-        data = []
-        if usepbar:
-            widgets = ['Reading: ', Percentage(),', ', ETA(), ' ', Bar()]
-            pbar = ProgressBar(widgets=widgets,maxval=lng, term_width=79).start()
+        # fill a preallocated buffer in place rather than concatenating
+        data = bytearray(lng)
+        mv = memoryview(data)
+        offs = 0
+        # locals for everything the chunk loop looks up
+        size = self.data_transfer_size
+        read = self.cmdReadMemory
+        debug = mdebug
+        pb = optional_import('progressbar')
+        showbar = pb is not None
+        if showbar:
+            widgets = ['Reading: ', pb.Percentage(),', ', pb.ETA(), ' ', pb.Bar()]
+            pbar = _BatchedProgress(pb.ProgressBar(widgets=widgets,maxval=lng, term_width=79).start())
         
-        while lng > 256:
-            if usepbar:
+        while lng > size:
+            if showbar:
                 pbar.update(pbar.maxval-lng)
             else:
-                mdebug(5, "Read %(len)d bytes at 0x%(addr)X" % {'addr': addr, 'len': 256})
-            data = data + self.cmdReadMemory(addr, 256)
-            addr = addr + 256
-            lng = lng - 256
-        if usepbar:
+                debug(5, "Read %d bytes at 0x%X", size, addr)
+            read(addr, size, mv[offs:offs+size])
+            offs = offs + size
+            addr = addr + size
+            lng = lng - size
+        if showbar:
             pbar.update(pbar.maxval-lng)
             pbar.finish()
         else:
-            mdebug(5, "Read %(len)d bytes at 0x%(addr)X" % {'addr': addr, 'len': 256})
-        data = data + self.cmdReadMemory(addr, lng)
+            mdebug(5, "Read %d bytes at 0x%X", lng, addr)
+        self.cmdReadMemory(addr, lng, mv[offs:offs+lng])
         return data
 
-    def writeMemory(self, addr, data):
+    def verifyMemory(self, addr, data):
+        # read flash back one chunk at a time and compare each chunk as it
+        # arrives, so the full image is never read into a second buffer;
+        # returns (offset, flash bytes) for every chunk that differs
         lng = len(data)
-        if usepbar:
-            widgets = ['Writing: ', Percentage(),' ', ETA(), ' ', Bar()]
-            pbar = ProgressBar(widgets=widgets, maxval=lng, term_width=79).start()
+        if not isinstance(data, (bytearray, buffer)):
+            data = bytearray(data)
+        mv = memoryview(data)
+        # one page buffer refilled for every chunk
+        page = memoryview(bytearray(self.data_transfer_size))
+        bad = []
+        offs = 0
+        # locals for everything the chunk loop looks up
+        size = self.data_transfer_size
+        read = self.cmdReadMemory
+        debug = mdebug
+        pb = optional_import('progressbar')
+        showbar = pb is not None
+        if showbar:
+            widgets = ['Verifying: ', pb.Percentage(),', ', pb.ETA(), ' ', pb.Bar()]
+            pbar = _BatchedProgress(pb.ProgressBar(widgets=widgets,maxval=lng, term_width=79).start())
+
+        while offs < lng:
+            n = min(size, lng - offs)
+            if showbar:
+                pbar.update(offs)
+            else:
+                debug(5, "Verify %d bytes at 0x%X", n, addr + offs)
+            chunk = page[:n]
+            read(addr + offs, n, chunk)
+            if chunk != mv[offs:offs+n]:
+                bad.append((offs, bytearray(chunk)))
+            offs = offs + n
+        if showbar:
+            pbar.update(lng)
+            pbar.finish()
+        return bad
+
+    def writeMemory(self, addr, data, pad = True):
+        # pad: fill the last chunk up to a whole transfer with 0xFF
+        lng = len(data)
+        pb = optional_import('progressbar')
+        if pb is not None:
+            widgets = ['Writing: ', pb.Percentage(),' ', pb.ETA(), ' ', pb.Bar()]
+            pbar = _BatchedProgress(pb.ProgressBar(widgets=widgets, maxval=lng, term_width=79).start())
         
+        # slices of a memoryview are views, not per-chunk copies
+        if not isinstance(data, (bytearray, buffer)):
+            data = bytearray(data)
+        mv = memoryview(data)
+        xors = page_xors(data, self.data_transfer_size)
         offs = 0
-        while lng > 256:
-            if usepbar:
+        # locals for everything the chunk loop looks up
+        size = self.data_transfer_size
+        write = self.cmdWriteMemory
+        debug = mdebug
+        showbar = pb is not None
+        while lng > size:
+            if showbar:
                 pbar.update(pbar.maxval-lng)
             else:
-                mdebug(5, "Write %(len)d bytes at 0x%(addr)X" % {'addr': addr, 'len': 256})
-            self.cmdWriteMemory(addr, data[offs:offs+256])
-            offs = offs + 256
-            addr = addr + 256
-            lng = lng - 256
-        if usepbar:
+                debug(5, "Write %d bytes at 0x%X", size, addr)
+            write(addr, mv[offs:offs+size], xors[offs // size])
+            offs = offs + size
+            addr = addr + size
+            lng = lng - size
+        if showbar:
             pbar.update(pbar.maxval-lng)
             pbar.finish()
+        elif pad:
+            mdebug(5, "Write %d bytes at 0x%X", size, addr)
         else:
-            mdebug(5, "Write %(len)d bytes at 0x%(addr)X" % {'addr': addr, 'len': 256})
-        self.cmdWriteMemory(addr, data[offs:offs+lng] + ([0xFF] * (256-lng)) )
+            mdebug(5, "Write %d bytes at 0x%X", lng, addr)
+        if not pad:
+            self.cmdWriteMemory(addr, mv[offs:offs+lng])
+            return
+        chunk = bytearray(mv[offs:offs+lng])
+        chunk.extend("\xFF" * (size-lng))
+        self.cmdWriteMemory(addr, chunk, xors[-1])
 
 
 
@@ -341,8 +743,12 @@ class CommandInterface:
         pass
 
 
+# options that just switch a conf entry on, and those taking a number
+flag_options = {'-e': 'erase', '-w': 'write', '-v': 'verify', '-r': 'read'}
+int_options = {'-b': 'baud', '-a': 'address', '-g': 'go_addr', '-l': 'len'}
+
 def usage():
-    print """Usage: %s [-hqVewvr] [-l length] [-p port] [-b baud] [-a addr] [-g addr] [file.bin]
+    print """Usage: %s [-hqVewvr] [-l length] [-p port] [-b baud] [-a addr] [-g addr] [file.bin|file.hex]
     -h          This help
     -q          Quiet
     -V          Verbose
@@ -380,6 +786,7 @@ if __name__ == "__main__":
             'verify': 0,
             'read': 0,
             'go_addr':-1,
+            'address_set': 0,
         }
 
 # http://www.python.org/doc/2.5.2/lib/module-getopt.html
@@ -402,30 +809,41 @@ if __name__ == "__main__":
         elif o == '-h':
             usage()
             sys.exit(0)
-        elif o == '-e':
-            conf['erase'] = 1
-        elif o == '-w':
-            conf['write'] = 1
-        elif o == '-v':
-            conf['verify'] = 1
-        elif o == '-r':
-            conf['read'] = 1
+        elif o in flag_options:
+            conf[flag_options[o]] = 1
+        elif o in int_options:
+            conf[int_options[o]] = int(a, 0)
+            if o == '-a':
+                conf['address_set'] = 1
         elif o == '-p':
             conf['port'] = a
-        elif o == '-b':
-            conf['baud'] = eval(a)
-        elif o == '-a':
-            conf['address'] = eval(a)
-        elif o == '-g':
-            conf['go_addr'] = eval(a)
-        elif o == '-l':
-            conf['len'] = eval(a)
         else:
             assert False, "unhandled option"
 
+    # options that depend on each other, checked before touching the port
+    err = None
+    if (conf['write'] or conf['verify'] or conf['read']) and not args:
+        err = "a file name is required with -w, -v or -r"
+    elif conf['read'] and not conf['write'] and 'len' not in conf:
+        err = "-l length is required with -r"
+    if err:
+        print err
+        usage()
+        sys.exit(2)
+
+    if (conf['write'] or conf['verify']):
+        base, data = load_image(args[0])
+        if base is not None:
+            # a .hex image knows where it goes; -a may only confirm it
+            if not conf['address_set']:
+                conf['address'] = base
+            elif conf['address'] != base:
+                print "%s starts at 0x%X, not at -a 0x%X" % (args[0], base, conf['address'])
+                sys.exit(2)
+
     cmd = CommandInterface()
     cmd.open(conf['port'], conf['baud'])
-    mdebug(10, "Open port %(port)s, baud %(baud)d" % {'port':conf['port'], 'baud':conf['baud']})
+    mdebug(10, "Open port %s, baud %d", conf['port'], conf['baud'])
     try:
         try:
             cmd.initChip()
@@ -434,18 +852,15 @@ if __name__ == "__main__":
 
 
         bootversion = cmd.cmdGet()
-        mdebug(0, "Bootloader version %X" % bootversion)
+        mdebug(0, "Bootloader version %X", bootversion)
         id = cmd.cmdGetID()
-        mdebug(0, "Chip id: 0x%x (%s)" % (id, chip_ids.get(id, "Unknown")))
+        mdebug(0, "Chip id: 0x%x (%s)", id, chip_ids.get(id, "Unknown"))
 #    cmd.cmdGetVersion()
 #    cmd.cmdGetID()
 #    cmd.cmdReadoutUnprotect()
 #    cmd.cmdWriteUnprotect()
 #    cmd.cmdWriteProtect([0, 1])
 
-        if (conf['write'] or conf['verify']):
-            data = map(lambda c: ord(c), file(args[0], 'rb').read())
-
         if conf['erase']:
             cmd.cmdEraseMemory()
 
@@ -453,19 +868,30 @@ if __name__ == "__main__":
             cmd.writeMemory(conf['address'], data)
 
         if conf['verify']:
-            verify = cmd.readMemory(conf['address'], len(data))
-            if(data == verify):
+            bad = cmd.verifyMemory(conf['address'], data)
+            if not bad:
                 print "Verification OK"
             else:
                 print "Verification FAILED"
-                print str(len(data)) + ' vs ' + str(len(verify))
-                for i in xrange(0, len(data)):
-                    if data[i] != verify[i]:
-                        print hex(i) + ': ' + hex(data[i]) + ' vs ' + hex(verify[i])
+                data = bytearray(data)
+                # a bad flash can differ everywhere, list only the first few
+                shown = 0
+                for offs, verify in bad:
+                    expect = data[offs:offs+len(verify)]
+                    for i in mismatches(expect, verify):
+                        if shown == 100:
+                            # only once a 101st mismatch shows up
+                            print "..."
+                            shown = shown + 1
+                            break
+                        print hex(offs+i) + ': ' + hex(expect[i]) + ' vs ' + hex(verify[i])
+                        shown = shown + 1
+                    if shown > 100:
+                        break
 
         if not conf['write'] and conf['read']:
             rdata = cmd.readMemory(conf['address'], conf['len'])
-            file(args[0], 'wb').write(''.join(map(chr,rdata)))
+            file(args[0], 'wb').write(rdata)
 
         if conf['go_addr'] != -1:
             cmd.cmdGo(conf['go_addr'])